@@ -1,17 +1,25 @@
 # api/main.py
 import os
-import json
+import io
+import re
+import asyncio
 import time
-import uuid
-import shutil
 import random
+import hashlib
+import functools
 import tempfile
+from collections import OrderedDict
 from typing import List
 
-import requests
-from fastapi import FastAPI, UploadFile, File, HTTPException, Body, Query
+import httpx
+import orjson
+import numpy as np
+from fastapi import FastAPI, UploadFile, File, HTTPException, Query
+from pydantic import BaseModel
 from fastapi.middleware.cors import CORSMiddleware
-from starlette.responses import JSONResponse
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
+import fitz  # PyMuPDF
 from pypdf import PdfReader
 from dotenv import load_dotenv
 
@@ -38,10 +46,25 @@ MODEL_FALLBACKS = [m for m in [
     "gpt-4",           # last-resort legacy alias
 ] if m]
 
+# Shared async client: keep-alive pooling avoids a fresh TCP+TLS handshake per call
+_client = httpx.AsyncClient(
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+    timeout=60.0,
+)
+
+# Optional semantic cache for /ask: active only if sentence-transformers is installed
+try:
+    from sentence_transformers import SentenceTransformer
+except ImportError:
+    SentenceTransformer = None
+
+CACHE_MAX = 1024
+SEMANTIC_THRESHOLD = 0.92
+
 # -----------------------------------------------------------------------------#
 # App + CORS
 # -----------------------------------------------------------------------------#
-app = FastAPI(title=API_TITLE, version="0.6.0")
+app = FastAPI(title=API_TITLE, version="0.6.0", default_response_class=ORJSONResponse)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=ALLOWED_ORIGINS,
@@ -49,12 +72,19 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# Large graph responses compress well; skip small ones not worth the CPU
+app.add_middleware(GZipMiddleware, minimum_size=1024)
 
 # -----------------------------------------------------------------------------#
 # Utilities
 # -----------------------------------------------------------------------------#
+@functools.lru_cache(maxsize=1)
 def blackbox_headers():
-    """Return headers that work across Blackbox auth styles."""
+    """Return headers that work across Blackbox auth styles.
+
+    Cached for the life of the process: the key comes from the environment,
+    which doesn't change after startup.
+    """
     key = (os.getenv("BLACKBOX_API_KEY") or "").strip()
     if not key:
         return None
@@ -64,62 +94,203 @@ def blackbox_headers():
         "Authorization": f"Bearer {key}", # style 2
     }
 
-def blackbox_chat(messages: list, temperature: float = 0.2) -> str:
+# Exact-match LRU over full chat calls; messages are unhashable so we key on a
+# digest of their JSON form instead of using functools.lru_cache.
+_chat_cache: "OrderedDict[str, str]" = OrderedDict()
+
+# Matches a whole ```/```json fenced block; one C-level scan instead of
+# repeated strip/startswith/slice passes over large responses
+_FENCE_RE = re.compile(r"^\s*```(?:json)?\s*(.*?)\s*```\s*$", re.DOTALL | re.IGNORECASE)
+
+def _strip_fences(content: str) -> str:
+    m = _FENCE_RE.match(content)
+    return m.group(1) if m else content.strip()
+
+def _digest(obj) -> str:
+    return hashlib.blake2b(orjson.dumps(obj, option=orjson.OPT_SORT_KEYS), digest_size=16).hexdigest()
+
+# Semantic tier: (graph_key, unit question vector, answer) per cached /ask hit
+_embedder = None
+_semantic_entries: list = []
+
+def _embed_question(question: str):
+    """Return a unit embedding of the question, or None if the model is unavailable."""
+    global _embedder
+    if SentenceTransformer is None:
+        return None
+    if _embedder is None:
+        _embedder = SentenceTransformer("all-MiniLM-L6-v2")
+    vec = _embedder.encode([question])[0]
+    return vec / np.linalg.norm(vec)
+
+def _semantic_lookup(question: str, graph_key: str):
+    """Return (vector, cached answer or None) for near-identical questions on this graph."""
+    vec = _embed_question(question)
+    if vec is None:
+        return None, None
+    candidates = [(v, ans) for gk, v, ans in _semantic_entries if gk == graph_key]
+    if candidates:
+        sims = np.stack([v for v, _ in candidates]) @ vec
+        best = int(sims.argmax())
+        if sims[best] >= SEMANTIC_THRESHOLD:
+            return vec, candidates[best][1]
+    return vec, None
+
+def _semantic_store(graph_key: str, vec, answer: str):
+    if vec is None:
+        return
+    if len(_semantic_entries) >= CACHE_MAX:
+        _semantic_entries.pop(0)
+    _semantic_entries.append((graph_key, vec, answer))
+
+# Single-flight: identical calls already in progress share one upstream request
+_inflight: dict[str, asyncio.Future] = {}
+# Per-process cap on concurrent upstream calls (each may race several models)
+_llm_semaphore = asyncio.Semaphore(8)
+
+async def blackbox_chat(messages: list, temperature: float = 0.2, use_cache: bool = True) -> str:
     """
-    Call Blackbox chat with model fallbacks.
+    Call Blackbox chat, racing all model fallbacks concurrently.
+    The first 200 wins and the remaining attempts are cancelled, so worst-case
+    latency is min(latencies) rather than the sum of per-model timeouts.
+    Identical in-flight calls are coalesced onto one upstream request.
     Returns the assistant text content or raises HTTPException.
     """
     headers = blackbox_headers()
     if not headers:
         raise HTTPException(status_code=500, detail="BLACKBOX_API_KEY not set")
 
-    errors: list[str] = []
-    for model in MODEL_FALLBACKS:
+    cache_key = _digest({"messages": messages, "temperature": temperature})
+    if use_cache and cache_key in _chat_cache:
+        _chat_cache.move_to_end(cache_key)
+        return _chat_cache[cache_key]
+
+    fut = _inflight.get(cache_key)
+    if fut is not None:
+        # Shield so one follower's cancellation can't poison the shared future
+        try:
+            return await asyncio.shield(fut)
+        except asyncio.CancelledError:
+            if fut.cancelled():
+                # The leader was cancelled, not us: retry as our own call
+                return await blackbox_chat(messages, temperature, use_cache)
+            raise
+    fut = asyncio.get_running_loop().create_future()
+    _inflight[cache_key] = fut
+    try:
+        content = await _blackbox_chat_race(cache_key, messages, temperature, headers, use_cache)
+    except asyncio.CancelledError:
+        fut.cancel()
+        raise
+    except Exception as e:
+        if not fut.cancelled():
+            fut.set_exception(e)
+            fut.exception()  # mark retrieved so cancelled followers don't warn
+        raise
+    finally:
+        _inflight.pop(cache_key, None)
+    if not fut.cancelled():
+        fut.set_result(content)
+    return content
+
+async def _blackbox_chat_race(cache_key: str, messages: list, temperature: float, headers: dict, use_cache: bool) -> str:
+    """Race the model fallbacks for one coalesced call; returns the winning content."""
+    async def attempt(model: str) -> tuple[str, httpx.Response | httpx.HTTPError]:
         payload = {"model": model, "messages": messages, "temperature": temperature}
         try:
-            resp = requests.post(BLACKBOX_API_URL, headers=headers, data=json.dumps(payload), timeout=60)
-        except requests.RequestException as e:
-            errors.append(f"{model}: network error {e}")
-            continue
-
-        if resp.status_code == 200:
-            try:
-                data = resp.json()
-                return data["choices"][0]["message"]["content"]
-            except Exception:
-                raise HTTPException(status_code=502, detail="Unexpected Blackbox response shape")
-
-        # 401: auth issue – no point trying more models
-        if resp.status_code == 401:
-            raise HTTPException(status_code=401, detail=f"Blackbox 401: {resp.text}")
-
-        # For model errors (400/404/422), try next model
-        errors.append(f"{model}: {resp.status_code} {resp.text[:200]}")
+            return model, await _client.post(BLACKBOX_API_URL, headers=headers, content=orjson.dumps(payload))
+        except httpx.HTTPError as e:
+            # Return rather than raise so the caller still knows which model failed
+            return model, e
+
+    await _llm_semaphore.acquire()
+    tasks = [asyncio.create_task(attempt(model)) for model in MODEL_FALLBACKS]
+    pending = set(tasks)
+    errors: list[str] = []
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                model, resp = task.result()
+                if isinstance(resp, httpx.HTTPError):
+                    errors.append(f"{model}: network error {resp}")
+                    continue
+
+                if resp.status_code == 200:
+                    try:
+                        data = orjson.loads(resp.content)
+                        content = data["choices"][0]["message"]["content"]
+                    except Exception:
+                        raise HTTPException(status_code=502, detail="Unexpected Blackbox response shape")
+                    if use_cache:
+                        _chat_cache[cache_key] = content
+                        while len(_chat_cache) > CACHE_MAX:
+                            _chat_cache.popitem(last=False)
+                    return content
+
+                # 401: auth issue – no point waiting on other models
+                if resp.status_code == 401:
+                    raise HTTPException(status_code=401, detail=f"Blackbox 401: {resp.text}")
+
+                # Model errors (400/404/422): keep waiting on the rest
+                errors.append(f"{model}: {resp.status_code} {resp.text[:200]}")
+    finally:
+        for task in pending:
+            task.cancel()
+        _llm_semaphore.release()
 
     raise HTTPException(status_code=502, detail=f"All models failed. Errors: {' | '.join(errors)}")
 
-def extract_text_from_file(path: str) -> str:
-    """Return plain text from .txt/.pdf; short note for unsupported types."""
-    lower = path.lower()
+MAX_CORPUS_CHARS = 120_000
+SPOOL_MAX_BYTES = 10 * 1024 * 1024
+
+def extract_text_from_upload(filename: str, buf, max_chars: int = MAX_CORPUS_CHARS) -> str:
+    """Return up to max_chars of plain text from an in-memory .txt/.pdf buffer."""
+    lower = (filename or "").lower()
+    buf.seek(0)
     if lower.endswith(".txt"):
-        with open(path, "r", encoding="utf-8", errors="ignore") as f:
-            return f.read()
+        # 4 bytes/char bounds any UTF-8 text at max_chars characters
+        return buf.read(4 * max_chars).decode("utf-8", errors="ignore")[:max_chars]
     if lower.endswith(".pdf"):
+        # PyMuPDF extracts in native code, several times faster than pypdf;
+        # keep pypdf as a fallback for PDFs MuPDF refuses to open.
+        # Either way, stop parsing pages once the budget is spent — anything
+        # past it would be truncated before the upstream call anyway.
+        data = buf.read()
         try:
-            reader = PdfReader(path)
-            return "\n".join(page.extract_text() or "" for page in reader.pages)
+            chunks, running_len = [], 0
+            with fitz.open(stream=data, filetype="pdf") as doc:
+                for page in doc:
+                    text = page.get_text("text")
+                    chunks.append(text)
+                    running_len += len(text) + 1
+                    if running_len >= max_chars:
+                        break
+            return "\n".join(chunks)[:max_chars]
         except Exception:
-            return f"[PDF: {os.path.basename(path)}; text extraction failed]"
-    return f"[Unsupported file type: {os.path.basename(path)}]"
+            pass
+        try:
+            reader = PdfReader(io.BytesIO(data))
+            chunks, running_len = [], 0
+            for page in reader.pages:
+                text = page.extract_text() or ""
+                chunks.append(text)
+                running_len += len(text) + 1
+                if running_len >= max_chars:
+                    break
+            return "\n".join(chunks)[:max_chars]
+        except Exception:
+            return f"[PDF: {filename}; text extraction failed]"
+    return f"[Unsupported file type: {filename}]"
 
-def call_blackbox_for_graph(texts: List[str]) -> dict:
+async def call_blackbox_for_graph(texts: List[str], use_cache: bool = True) -> dict:
     """
     Build a knowledge graph from raw texts via Blackbox.
     Returns: {"clusters":[...], "links":[...], "summary": "..."}
     """
     joined = "\n\n".join(texts)
-    if len(joined) > 120_000:
-        joined = joined[:120_000]
+    if len(joined) > MAX_CORPUS_CHARS:
+        joined = joined[:MAX_CORPUS_CHARS]
 
     system = (
         "You are InsightGraph, an analysis engine that turns multiple documents into a knowledge graph. "
@@ -133,24 +304,20 @@ def call_blackbox_for_graph(texts: List[str]) -> dict:
         "relation_label short (<=3 words). The summary is 4-7 sentences, executive tone. Return ONLY JSON."
     )
 
-    content = blackbox_chat(
+    content = await blackbox_chat(
         messages=[
             {"role": "system", "content": system},
             {"role": "user", "content": joined},
         ],
-        temperature=0.2
+        temperature=0.2,
+        use_cache=use_cache,
     )
 
     # Strip code fences if LLM wrapped JSON
-    s = content.strip()
-    if s.startswith("```"):
-        s = s.strip("`")
-        if s.lower().startswith("json"):
-            s = s[4:]
-        s = s.strip()
+    s = _strip_fences(content)
 
     try:
-        parsed = json.loads(s)
+        parsed = orjson.loads(s)
         for k in ["clusters", "links", "summary"]:
             if k not in parsed:
                 raise ValueError(f"Missing key: {k}")
@@ -158,35 +325,154 @@ def call_blackbox_for_graph(texts: List[str]) -> dict:
     except Exception as e:
         raise HTTPException(status_code=502, detail=f"Failed to parse model JSON: {e}")
 
-def call_blackbox_for_answer(question: str, graph_context: dict) -> str:
-    """Q&A grounded in the existing graph context."""
-    ctx = {
+def _graph_context(graph_context: dict) -> dict:
+    """Trim a graph down to the context we are willing to send upstream.
+
+    Reuses the caller's cluster dicts, shallow-copying one only when its
+    lists actually need trimming, instead of rebuilding every dict per call.
+    """
+    clusters = []
+    for c in (graph_context.get("clusters") or [])[:10]:
+        concepts = c.get("concepts") or []
+        docs = c.get("source_docs") or []
+        if len(concepts) > 10 or len(docs) > 5:
+            c = {**c, "concepts": concepts[:10], "source_docs": docs[:5]}
+        clusters.append(c)
+    return {
         "summary": graph_context.get("summary", ""),
-        "clusters": [
-            {
-                "id": c.get("id"),
-                "label": c.get("label"),
-                "concepts": (c.get("concepts") or [])[:10],
-                "docs": (c.get("source_docs") or [])[:5],
-            }
-            for c in (graph_context.get("clusters") or [])[:10]
-        ],
+        "clusters": clusters,
         "links": (graph_context.get("links") or [])[:30],
     }
 
+def _answer_messages(question: str, graph_context: dict) -> list:
+    """Build the QA chat messages shared by the buffered and streaming paths."""
     system = (
         "You are InsightGraph QA. Answer the user's question using ONLY the provided context. "
         "Return a concise, actionable answer (4-8 sentences). If context is insufficient, say what is missing. "
         "When useful, refer to cluster labels or document names from the context."
     )
+    ctx = _graph_context(graph_context)
+    return [
+        {"role": "system", "content": system},
+        {"role": "user", "content": f"Question: {question}\n\nContext JSON:\n{orjson.dumps(ctx).decode()}"},
+    ]
 
-    return blackbox_chat(
-        messages=[
-            {"role": "system", "content": system},
-            {"role": "user", "content": f"Question: {question}\n\nContext JSON:\n{json.dumps(ctx, ensure_ascii=False)}"},
-        ],
-        temperature=0.2
-    ).strip()
+async def call_blackbox_for_answer(question: str, graph_context: dict, use_cache: bool = True) -> str:
+    """Q&A grounded in the existing graph context."""
+    content = await blackbox_chat(
+        messages=_answer_messages(question, graph_context),
+        temperature=0.2,
+        use_cache=use_cache,
+    )
+    return content.strip()
+
+async def stream_blackbox_answer(question: str, graph_context: dict):
+    """Yield SSE frames of answer deltas, trying model fallbacks until one streams."""
+    headers = blackbox_headers()
+    messages = _answer_messages(question, graph_context)
+    errors: list[str] = []
+    for model in MODEL_FALLBACKS:
+        payload = {"model": model, "messages": messages, "temperature": 0.2, "stream": True}
+        try:
+            async with _client.stream(
+                "POST", BLACKBOX_API_URL, headers=headers, content=orjson.dumps(payload)
+            ) as resp:
+                if resp.status_code != 200:
+                    body = await resp.aread()
+                    errors.append(f"{model}: {resp.status_code} {body[:200]!r}")
+                    if resp.status_code == 401:
+                        break
+                    continue
+                async for line in resp.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[5:].strip()
+                    if data == "[DONE]":
+                        yield "data: [DONE]\n\n"
+                        return
+                    try:
+                        delta = orjson.loads(data)["choices"][0]["delta"].get("content") or ""
+                    except Exception:
+                        continue
+                    if delta:
+                        yield f"data: {orjson.dumps({'delta': delta}).decode()}\n\n"
+                yield "data: [DONE]\n\n"
+                return
+        except httpx.HTTPError as e:
+            errors.append(f"{model}: network error {e}")
+    detail = "All models failed. Errors: " + " | ".join(errors)
+    yield f"data: {orjson.dumps({'error': detail}).decode()}\n\n"
+
+# --------------------------- /ask micro-batching -----------------------------#
+# Concurrent questions against the same graph are coalesced into one upstream
+# chat call that returns a JSON array of answers, instead of N independent calls.
+BATCH_MAX = 16
+BATCH_WINDOW_MS = 50
+
+_ask_queue: asyncio.Queue = asyncio.Queue()
+_batcher_task: asyncio.Task | None = None
+
+async def _answer_group(items: list) -> None:
+    """Answer a batch of questions sharing one graph; fan results to their futures."""
+    use_cache = all(it["use_cache"] for it in items)
+    try:
+        if len(items) == 1:
+            it = items[0]
+            it["future"].set_result(await call_blackbox_for_answer(it["question"], it["graph"], use_cache))
+            return
+
+        system = (
+            "You are InsightGraph QA. Answer each of the numbered questions using ONLY the provided context. "
+            f"Return a strict JSON array of exactly {len(items)} answer strings, in question order. "
+            "Each answer is concise and actionable (4-8 sentences). If context is insufficient, "
+            "say what is missing. Return ONLY JSON."
+        )
+        questions = "\n".join(f"{i+1}. {it['question']}" for i, it in enumerate(items))
+        ctx = _graph_context(items[0]["graph"])
+        content = await blackbox_chat(
+            messages=[
+                {"role": "system", "content": system},
+                {"role": "user", "content": f"Questions:\n{questions}\n\nContext JSON:\n{orjson.dumps(ctx).decode()}"},
+            ],
+            temperature=0.2,
+            use_cache=use_cache,
+        )
+
+        answers = orjson.loads(_strip_fences(content))
+        if not isinstance(answers, list) or len(answers) != len(items):
+            raise ValueError("batched answer shape mismatch")
+        for it, answer in zip(items, answers):
+            it["future"].set_result(str(answer).strip())
+    except Exception:
+        # Fall back to one call per question rather than failing the whole batch
+        for it in items:
+            if it["future"].done():
+                continue
+            try:
+                it["future"].set_result(await call_blackbox_for_answer(it["question"], it["graph"], it["use_cache"]))
+            except Exception as e:
+                it["future"].set_exception(e)
+
+async def _drain_ask_queue() -> None:
+    """Collect questions arriving within BATCH_WINDOW_MS (up to BATCH_MAX) and dispatch per graph."""
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await _ask_queue.get()]
+        deadline = loop.time() + BATCH_WINDOW_MS / 1000
+        while len(batch) < BATCH_MAX:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(_ask_queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+
+        groups: dict[str, list] = {}
+        for it in batch:
+            groups.setdefault(it["graph_key"], []).append(it)
+        for items in groups.values():
+            asyncio.create_task(_answer_group(items))
 
 # ------------------------- Synthetic /sample generator ------------------------#
 LABEL_BANK = [
@@ -209,6 +495,7 @@ CONCEPT_BANK = [
 ]
 REL_LABELS = ["depends","informs","tradeoff","enables","costs","relates"]
 
+@functools.lru_cache(maxsize=256)
 def build_sample_graph(n_clusters=12, concepts_per=7, link_prob=0.35, seed=42):
     rng = random.Random(seed)
     labels = rng.sample(LABEL_BANK, k=min(n_clusters, len(LABEL_BANK)))
@@ -224,20 +511,22 @@ def build_sample_graph(n_clusters=12, concepts_per=7, link_prob=0.35, seed=42):
             "source_docs": docs
         })
 
+    n = len(clusters)
     links = []
     # ring for connectivity
-    for i in range(len(clusters)):
-        j = (i+1) % len(clusters)
+    for i in range(n):
+        j = (i+1) % n
         links.append({"source": clusters[i]["id"], "target": clusters[j]["id"], "relation_label": "related"})
-    # random extra links
-    for i in range(len(clusters)):
-        for j in range(i+2, len(clusters)):
-            if rng.random() < link_prob:
-                links.append({
-                    "source": clusters[i]["id"],
-                    "target": clusters[j]["id"],
-                    "relation_label": rng.choice(REL_LABELS)
-                })
+    # random extra links: draw the whole pair matrix at once instead of an
+    # interpreted O(n^2) loop of rng.random() calls
+    probs = np.random.default_rng(seed).random((n, n))
+    mask = np.triu(np.ones((n, n), dtype=bool), k=2)
+    for i, j in zip(*np.where(mask & (probs < link_prob))):
+        links.append({
+            "source": clusters[int(i)]["id"],
+            "target": clusters[int(j)]["id"],
+            "relation_label": rng.choice(REL_LABELS)
+        })
 
     summary = (
         f"{n_clusters} thematic clusters link policy, technology, and deployment. "
@@ -246,9 +535,32 @@ def build_sample_graph(n_clusters=12, concepts_per=7, link_prob=0.35, seed=42):
     )
     return {"clusters": clusters, "links": links, "summary": summary}
 
+SAMPLE_PRESETS = {
+    "small":  {"n": 3,  "concepts": 6, "p": 0.25},
+    "medium": {"n": 8,  "concepts": 7, "p": 0.33},
+    "large":  {"n": 14, "concepts": 8, "p": 0.40},
+}
+
 # -----------------------------------------------------------------------------#
 # Routes
 # -----------------------------------------------------------------------------#
+@app.on_event("startup")
+async def start_batcher():
+    global _batcher_task
+    _batcher_task = asyncio.create_task(_drain_ask_queue())
+    # Warm the memoized sample graphs for the default seed
+    for cfg in SAMPLE_PRESETS.values():
+        build_sample_graph(n_clusters=cfg["n"], concepts_per=cfg["concepts"], link_prob=cfg["p"], seed=42)
+    # Load the embedding model now instead of lazily inside the first /ask
+    if SentenceTransformer is not None:
+        await asyncio.to_thread(_embed_question, "warm up")
+
+@app.on_event("shutdown")
+async def close_client():
+    if _batcher_task:
+        _batcher_task.cancel()
+    await _client.aclose()
+
 @app.get("/health")
 def health():
     return {"status": "ok"}
@@ -267,19 +579,14 @@ def sample(
     link_prob: float | None = Query(None),
 ):
     """Generate a demo graph: returns {clusters, links, summary}."""
-    presets = {
-        "small":  {"n": 3,  "concepts": 6, "p": 0.25},
-        "medium": {"n": 8,  "concepts": 7, "p": 0.33},
-        "large":  {"n": 14, "concepts": 8, "p": 0.40},
-    }
-    cfg = presets.get(size, presets["small"])
+    cfg = SAMPLE_PRESETS.get(size, SAMPLE_PRESETS["small"])
     n = clusters or cfg["n"]
     c = concepts or cfg["concepts"]
     p = link_prob if link_prob is not None else cfg["p"]
     return build_sample_graph(n_clusters=n, concepts_per=c, link_prob=p, seed=seed)
 
 @app.post("/analyze")
-async def analyze(files: List[UploadFile] = File(...)):
+async def analyze(files: List[UploadFile] = File(...), no_cache: bool = Query(False)):
     """
     Upload .txt/.pdf, build a knowledge graph via Blackbox, return {clusters, links, summary}.
     """
@@ -288,33 +595,81 @@ async def analyze(files: List[UploadFile] = File(...)):
     if len(files) > 20:
         raise HTTPException(status_code=413, detail="Too many files (max 20)")
 
-    tmpdir = tempfile.mkdtemp(prefix=f"igbx-{uuid.uuid4().hex[:6]}-")
-    try:
-        texts, names = [], []
-        for f in files:
-            if getattr(f, "size", None) and f.size > 20 * 1024 * 1024:
-                raise HTTPException(status_code=413, detail=f"{f.filename} exceeds 20MB limit")
-            path = os.path.join(tmpdir, f.filename or "doc")
-            with open(path, "wb") as out:
-                out.write(await f.read())
-            names.append(os.path.basename(path))
-            texts.append(extract_text_from_file(path))
-
-        joined = "\n\n".join([f"# FILE: {n}\n{t}" for n, t in zip(names, texts)])
-        result = call_blackbox_for_graph([joined])
-        return JSONResponse(result)
-    finally:
-        shutil.rmtree(tmpdir, ignore_errors=True)
+    # Split the corpus budget across files so one big PDF can't crowd out the rest
+    per_file = MAX_CORPUS_CHARS // len(files)
+
+    async def save_and_extract(f: UploadFile) -> tuple[str, str]:
+        name = os.path.basename(f.filename or "doc")
+        # Buffer in memory, spilling to disk only past SPOOL_MAX_BYTES; the
+        # size cap counts bytes actually received, not the client-reported size.
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES) as buf:
+            written = 0
+            while chunk := await f.read(1 << 20):
+                written += len(chunk)
+                if written > 20 * 1024 * 1024:
+                    raise HTTPException(status_code=413, detail=f"{f.filename} exceeds 20MB limit")
+                buf.write(chunk)
+            # PDF extraction is CPU-bound native code that releases the GIL,
+            # so files extract in parallel across worker threads.
+            text = await asyncio.to_thread(extract_text_from_upload, name, buf, per_file)
+        return name, text
+
+    results = await asyncio.gather(*(save_and_extract(f) for f in files))
+
+    # Write the corpus into one buffer instead of allocating per-file
+    # formatted strings plus their concatenation; per-file budgets above
+    # already bound the total near MAX_CORPUS_CHARS.
+    corpus = io.StringIO()
+    for name, text in results:
+        corpus.write("# FILE: ")
+        corpus.write(name)
+        corpus.write("\n")
+        corpus.write(text)
+        corpus.write("\n\n")
+
+    result = await call_blackbox_for_graph([corpus.getvalue()], use_cache=not no_cache)
+    return ORJSONResponse(result)
+
+class AskRequest(BaseModel):
+    question: str
+    graph: dict = {}
 
 @app.post("/ask")
-def ask(payload: dict = Body(...)):
+async def ask(payload: AskRequest, no_cache: bool = Query(False), stream: bool = Query(False)):
     """
     Payload: { "question": str, "graph": {clusters:[], links:[], summary:""} }
-    Returns: { "answer": str }
+    Returns: { "answer": str }, or SSE frames of {"delta": str} with ?stream=1.
     """
-    q = (payload or {}).get("question", "").strip()
-    graph = (payload or {}).get("graph") or {}
+    q = payload.question.strip()
+    graph = payload.graph
     if not q:
         raise HTTPException(status_code=400, detail="Missing question")
-    answer = call_blackbox_for_answer(q, graph)
+
+    if stream:
+        # Streamed answers skip the batcher and caches: tokens go to the
+        # client as they arrive instead of waiting for the full completion.
+        if not blackbox_headers():
+            raise HTTPException(status_code=500, detail="BLACKBOX_API_KEY not set")
+        return StreamingResponse(stream_blackbox_answer(q, graph), media_type="text/event-stream")
+
+    graph_key = _digest(graph)
+    vec = None
+    if not no_cache:
+        # Embedding is CPU-bound; keep it off the event loop
+        vec, cached = await asyncio.to_thread(_semantic_lookup, q, graph_key)
+        if cached is not None:
+            return {"answer": cached}
+
+    item = {
+        "question": q,
+        "graph": graph,
+        "graph_key": graph_key,
+        "use_cache": not no_cache,
+        "future": asyncio.get_running_loop().create_future(),
+    }
+    await _ask_queue.put(item)
+    answer = await item["future"]
+
+    if not no_cache:
+        _semantic_store(graph_key, vec, answer)
     return {"answer": answer}